@@ -1,12 +1,13 @@
-import csv
 import logging
 import os
-from collections import Counter
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from pprint import pprint
 
 import numpy as np
 import pandas as pd
-from extractor import parse_file_to_leet
+from extractor import (PARSE_CHUNK_SIZE, add_time_parts, parse_log_chunk,
+                       read_file_chunks)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -18,6 +19,13 @@ formatter = logging.Formatter('%(asctime)s - %(name)s'
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
+# Compact dtypes of parsed logs, message owners are a small set of names
+LOG_DTYPES = {'is_leet': 'int8', 'is_zeet': 'int8', 'is_420': 'int8',
+              'is_soli': 'int8', 'is_fail': 'int8',
+              'year': 'int16', 'month': 'int8', 'day': 'int8',
+              'hour': 'int8', 'minute': 'int8',
+              'message_owner': 'category'}
+
 
 def map_root_to_other_logs(parsed_whatsapp_logs, base_file):
     """
@@ -57,14 +65,17 @@ def create_mapping_dict(base_file, files_to_map, parsed_whatsapp_logs):
 
     """
     base_df = parsed_whatsapp_logs[base_file]
+    base_map = build_owner_lookup(base_df)
     mapping_dict = dict()
     for fname in files_to_map:
-        mapping = map_message_owner_names(base_df, fname, parsed_whatsapp_logs)
+        mapping = map_message_owner_names(base_df, fname, parsed_whatsapp_logs,
+                                          base_map=base_map)
         mapping_dict[fname] = mapping
     return mapping_dict
 
 
-def map_message_owner_names(base_df, fname, parsed_whatsapp_logs):
+def map_message_owner_names(base_df, fname, parsed_whatsapp_logs,
+                            base_map=None):
     """
     Method to map message_owners from one file to another.
     This is a bit involved so let me explain my reasoning here:
@@ -83,26 +94,52 @@ def map_message_owner_names(base_df, fname, parsed_whatsapp_logs):
     :param base_df: (pd.DataFrame) base dataframe used for mapping
     :param fname: filename of base file
     :param parsed_whatsapp_logs: complete data dict containing all logs
+    :param base_map: (pd.Series) optional, lookup of base_df created by
+    build_owner_lookup, avoids hashing base_df again for every file
     :return: (dict) mapping from one contact to another
     """
     logger.info('Finding Conversion for: {}'.format(fname))
     map_df = parsed_whatsapp_logs[fname]
+    if base_map is None:
+        base_map = build_owner_lookup(base_df)
+
+    mapped_owners = hash_messages(map_df).map(base_map)
+    cnts = pd.crosstab(map_df.message_owner, mapped_owners)
 
-    merged_dfs = pd.merge(base_df, map_df,
-                          on=['message_text', 'day', 'month', 'year'])
-    cnts = (merged_dfs
-            .groupby('message_owner_x')
-            .message_owner_y
-            .value_counts(normalize=True))
-
-    mapping = list()
-    for key, group in cnts.groupby(level=0):
-        mapping.append(group.idxmax()[::-1])
-    mapping = dict(mapping)
+    mapping = cnts.idxmax(axis=1).to_dict()
     logger.info('Created conversion: {}'.format(mapping))
     return mapping
 
 
+def build_owner_lookup(base_df):
+    """
+    Creates a lookup from hashed messages to their message owner.
+    Messages written by more than one owner (e.g. 420) are ambiguous
+    and not used for the mapping
+
+    :param base_df: (pd.DataFrame) base dataframe used for mapping
+    :return: (pd.Series) message owner indexed by message hash
+    """
+    base_keys = pd.DataFrame({'key': hash_messages(base_df).values,
+                              'owner': base_df.message_owner.values})
+    base_keys = (base_keys
+                 .drop_duplicates()
+                 .drop_duplicates('key', keep=False))
+    return pd.Series(base_keys.owner.values, index=base_keys.key.values)
+
+
+def hash_messages(df):
+    """
+    Hashes message content and date of every message, used as a key to
+    find the same message in different logs
+
+    :param df: (pd.DataFrame) dataframe of messages
+    :return: (pd.Series) uint64 hashes with the same index as df
+    """
+    return pd.util.hash_pandas_object(df[['message_text', 'day',
+                                          'month', 'year']], index=False)
+
+
 def map_names(parsed_whatsapp_logs):
     """
     Function that maps message_owners in all logfiles to the same
@@ -138,6 +175,9 @@ def find_root_mapping_file(parsed_whatsapp_logs):
 
     :return: (str) basefile name
     """
+    if len(parsed_whatsapp_logs) == 1:
+        return next(iter(parsed_whatsapp_logs))
+
     max_uniques = 0
     utv_ratio = 0
     base_file = None
@@ -145,10 +185,10 @@ def find_root_mapping_file(parsed_whatsapp_logs):
         if parsed_whatsapp_logs[key].empty:
             continue
 
-        unique_owners = parsed_whatsapp_logs[key]['message_owner'].unique()
-        valid_names = [x for x in unique_owners
-                       if not any(c.isdigit() for c in x)]
-        valid_users = len(valid_names)
+        unique_owners = pd.Series(
+            parsed_whatsapp_logs[key]['message_owner'].unique())
+        has_digit = unique_owners.str.contains(r'\d', regex=True, na=False)
+        valid_users = int((~has_digit).sum())
         unique_to_valid_ratio = valid_users / float(len(unique_owners))
 
         logger.info('Total-Users: {},Valid-Users: {}, '
@@ -164,113 +204,117 @@ def find_root_mapping_file(parsed_whatsapp_logs):
     return base_file
 
 
-def get_section_winners(day, month, year, parsed_whatsapp_logs, feat_key):
+def aggregate_daily_occurences(file_df):
     """
-    Calculates the winners of a certain leet/zeet time accross all logs.
-    Also solves disputes between mutliple logfile. i.E.: If a zeet is only
-    determined as a win if the majority of the logfiles says so.
-    If it's a 50:50 split the zeet is counted as a win.
-    
-    :param day:  (int)
-    :param month:  (int)
-    :param year:  (int)
-    :param parsed_whatsapp_logs:(dict)
-    {'filename': (pd.DataFrame),...} 
-    :param feat_key: (str) determining which feature should be evaluated
-    (feasible for is_zeet and is_leet)
-    :return: (list) list of winners
+    Calculates the occurences of leet, zeet and 420 messages for every
+    day and message owner of a single log in one pass.
+    Duplicates are filtered, a message owner can win leet and zeet once
+    a day and 420 twice a day (4:20 and 16:20)
+
+    :param file_df: (pd.DataFrame) dataframe of messages
+    :return: (pd.DataFrame) occurences indexed by
+    (year, month, day, message_owner) with columns is_leet, is_zeet, is_420.
+    is_420 is NaN for message owners without messages at 4 or 16 o'clock
     """
-    scaffold_df = pd.DataFrame()
-    for key in parsed_whatsapp_logs:
-        file_df = parsed_whatsapp_logs[key]
-        mask = get_date_mask(day, file_df, month, year)
-        sel_df = file_df[mask]
-        occ_count = (sel_df
-                     .groupby('message_owner')[feat_key]
-                     .sum())
-
-        # Filter possible duplicates
-        occ_count[occ_count > 1] = 1
-        scaffold_df[key] = occ_count
-    aggregated = scaffold_df.mean(axis=1)
-    # in dubio pro reo
-    winners = aggregated[aggregated >= 0.5].index.tolist()
-    return winners
-
-
-def get_winner_420(day, month, year, parsed_whatsapp_logs):
+    day_keys = ['year', 'month', 'day', 'message_owner']
+    occs = (file_df
+            .groupby(day_keys, observed=True)[['is_leet', 'is_zeet']]
+            .sum()
+            .clip(upper=1))
+
+    df_420 = file_df[file_df.hour.isin([4, 16])]
+    occs['is_420'] = (df_420
+                      .groupby(day_keys + ['hour'], observed=True)
+                      .is_420
+                      .sum()
+                      .clip(upper=1)
+                      .groupby(level=day_keys, observed=True)
+                      .sum())
+    return occs
+
+
+def get_daily_win_counts(parsed_whatsapp_logs, dates=None):
     """
-    Special method to determine a 420 message win. Since 420 is possible
-    at multiple times it's a little more involved to calculate.
-    First determine a winner for 16:20 and 4:20 then aggregate
+    Calculates the wins of every day accross all logs at once.
+    Also solves disputes between mutliple logfiles, a leet or zeet is
+    only a win if the majority of the logfiles with messages of the
+    owner on that day says so. If it's a 50:50 split it is counted as
+    a win. The 420 wins are the rounded mean over these logfiles.
 
-    :param day: (int)
-    :param month: (int)
-    :param year: (int)
     :param parsed_whatsapp_logs:(dict)
     {'filename': (pd.DataFrame),...}
-    :return: (list) list of winners, if someone has won both 4:20 and 16:20
-    the person will appear twice in the list
+    :param dates: (pd.DatetimeIndex) optional, only messages between the
+    first and last date are aggregated
+    :return: (pd.DataFrame) number of wins indexed by
+    (year, month, day, message_owner) with columns is_leet, is_zeet, is_420
     """
-    scaffold_df = pd.DataFrame()
-    for key in parsed_whatsapp_logs:
-        file_df = parsed_whatsapp_logs[key]
-        mask = get_date_mask(day, file_df, month, year)
-        mask_16 = mask & (file_df.hour == 16)
-        mask_04 = mask & (file_df.hour == 4)
-
-        occs_420 = calc_occurences_420(file_df, mask_04, mask_16)
-        scaffold_df[key] = occs_420
+    occs = pd.concat([aggregate_daily_occurences(select_dates(file_df, dates))
+                      for file_df in parsed_whatsapp_logs.values()])
+    # mean over all logs containing messages of the owner on that day
+    aggregated = (occs
+                  .groupby(level=occs.index.names, observed=True)
+                  .mean())
 
-    retval = list()
-    form_vals = np.round(scaffold_df.mean(axis=1).fillna(0), 0).astype(int)
-    for key, val in form_vals.items():
-        retval.extend([key] * val)
+    return pd.DataFrame(dict(
+        # in dubio pro reo
+        is_leet=(aggregated.is_leet >= 0.5).astype(int),
+        is_zeet=(aggregated.is_zeet >= 0.5).astype(int),
+        is_420=np.round(aggregated.is_420.fillna(0), 0).astype(int)))
 
-    return retval
 
-
-def calc_occurences_420(file_df, mask_04, mask_16):
+def select_dates(file_df, dates=None):
     """
-    Calculate the occurences for 16:20 and 4:20
+    Selects the messages within a range of dates before aggregating.
+    Messages can't be filtered by their is_* flags instead, since messages
+    without a flag count as votes against a win (see get_daily_win_counts)
+
     :param file_df: (pd.DataFrame) dataframe of messages
-    :param mask_04: (pd.Series of bools) mask to select 4:20 users on a
-    certain day
-    :param mask_16: (pd.Series of bools) mask to select 16:20 users
-    on a certain day
-    :return:(pd.Series) Series of Occurences indexed by message owner
+    :param dates: (pd.DatetimeIndex) optional, dates to select
+    :return: (pd.DataFrame) messages between the first and last date
     """
-    occ_count_04 = (file_df[mask_04]
-                    .groupby('message_owner')
-                    .is_420
-                    .sum())
-    occ_count_04[occ_count_04 > 1] = 1
-
-    occ_count_16 = (file_df[mask_16]
-                    .groupby('message_owner')
-                    .is_420
-                    .sum())
-    occ_count_16[occ_count_16 > 1] = 1
+    if dates is None or file_df.empty:
+        return file_df
+    mask = ((file_df.message_time >= dates[0])
+            & (file_df.message_time < dates[-1] + pd.Timedelta(days=1)))
+    if mask.all():
+        return file_df
+    return file_df[mask]
 
-    scaff = pd.DataFrame()
-    scaff['04'] = occ_count_04
-    scaff['16'] = occ_count_16
-    occs_420 = scaff.sum(axis=1)
-    return occs_420
 
-
-def get_date_mask(day, file_df, month, year):
-    mask = ((file_df.day == day)
-            & (file_df.month == month)
-            & (file_df.year == year))
-    return mask
+def tabulate_wins(win_counts, dates):
+    """
+    Tabulates the wins of every message owner for a range of dates.
+    Dates and message owners are converted to integer positions, so the
+    table is filled with a single np.add.at instead of counting per day
+
+    :param win_counts: (pd.Series) number of wins indexed by
+    (year, month, day, message_owner)
+    :param dates: (pd.DatetimeIndex) dates to tabulate
+    :return: (pd.DataFrame) wins indexed by date with a column per
+    message owner (in order of their first win), 0 if no win
+    """
+    wins = win_counts[win_counts > 0]
+    win_dates = pd.to_datetime(pd.DataFrame(dict(
+        year=wins.index.get_level_values('year'),
+        month=wins.index.get_level_values('month'),
+        day=wins.index.get_level_values('day'))))
+    date_pos = dates.get_indexer(win_dates)
+    in_range = date_pos >= 0
+
+    owner_codes, owners = pd.factorize(
+        np.asarray(wins.index.get_level_values('message_owner'))[in_range])
+    table = np.zeros((len(dates), len(owners)), dtype=np.int64)
+    np.add.at(table, (date_pos[in_range], owner_codes),
+              wins.values[in_range])
+    return pd.DataFrame(table, index=dates, columns=owners)
 
 
 def count_leet_and_greet(data_folder, start='01-01-2019', end='12-31-2019'):
     """
     Aggregating function to  count leets and greets over the course of a
-    given time range. Iterates on timerange calculates winner for each
-    day.
+    given time range. Calculates the winners of all days at once and
+    tabulates them for the time range. The cumulated counts per day are
+    written to /tmp/{420,leet,zeet}.csv
 
     :param data_folder: Folder to parse data from
     :param start: (str) time to start (american time format)
@@ -287,44 +331,43 @@ def count_leet_and_greet(data_folder, start='01-01-2019', end='12-31-2019'):
     mapping = map_names(parsed_files_dict)
     key = (set(mapping.keys()) ^ set(parsed_files_dict.keys())).pop()
     people = parsed_files_dict[key].message_owner.unique().tolist()
-    counter_zeet = Counter()
-    counter_leet = Counter()
-    counter_420 = Counter()
-    data_file_420 = open('/tmp/420.csv', 'w')
-    data_file_leet = open('/tmp/leet.csv', 'w')
-    data_file_zeet = open('/tmp/zeet.csv', 'w')
-    w1 = csv.DictWriter(data_file_420, people)
-    w2 = csv.DictWriter(data_file_leet, people)
-    w3 = csv.DictWriter(data_file_zeet, people)
-    w1.writeheader()
-    w2.writeheader()
-    w3.writeheader()
     logger.info('Users found: %s', ",".join(mapping))
 
-    for date in pd.date_range(start, end):
-        logger.info('Calculating winners for: {}'.format(date))
-        year = date.year
-        month = date.month
-        day = date.day
-        winner_partial = lambda x: get_section_winners(
-            day=day, month=month, year=year,
-            parsed_whatsapp_logs=parsed_files_dict,
-            feat_key=x
-        )
-
-        winner_leet = winner_partial('is_leet')
-        winner_zeet = winner_partial('is_zeet')
-        winner_420 = get_winner_420(day, month, year, parsed_files_dict)
-        counter_leet += Counter(winner_leet)
-        counter_zeet += Counter(winner_zeet)
-        counter_420 += Counter(winner_420)
-        w1.writerow(counter_420)
-        w2.writerow(counter_leet)
-        w3.writerow(counter_zeet)
-
-        logger.info(winner_leet)
-        logger.info(counter_leet)
-    return dict(zeet=counter_zeet, leet=counter_leet, fourtwenty=counter_420)
+    dates = pd.date_range(start, end)
+    logger.info('Calculating winners from {} to {}'.format(start, end))
+    win_counts = get_daily_win_counts(parsed_files_dict, dates)
+
+    counters = dict()
+    outputs = [('is_420', 'fourtwenty', '/tmp/420.csv'),
+               ('is_leet', 'leet', '/tmp/leet.csv'),
+               ('is_zeet', 'zeet', '/tmp/zeet.csv')]
+    for feat_key, name, csv_path in outputs:
+        wins = tabulate_wins(win_counts[feat_key], dates)
+        write_cumulated_wins(wins, people, csv_path)
+
+        totals = wins.sum()
+        counters[name] = Counter(totals[totals > 0].to_dict())
+        logger.info('{}: {}'.format(name, counters[name]))
+    return counters
+
+
+def write_cumulated_wins(wins, people, csv_path):
+    """
+    Writes the cumulated wins per day to a csv file in one batch.
+    Columns are the given people, followed by winners missing in people
+
+    :param wins: (pd.DataFrame) wins per date and message owner,
+    see tabulate_wins
+    :param people: (list) message owners used as columns
+    :param csv_path: (str) path of the csv file
+    """
+    columns = people + [x for x in wins.columns if x not in people]
+    cumulated = (wins
+                 .cumsum()
+                 .reindex(columns=columns, fill_value=0)
+                 .astype(np.int32))
+    with open(csv_path, 'w', newline='', buffering=1 << 20) as f:
+        cumulated.to_csv(f, index=False)
 
 
 def parse_log_files(data_folder):
@@ -342,18 +385,46 @@ def parse_log_files(data_folder):
     logger.info('Reading from: {}'.format(data_folder))
     data_files = [x for x in os.listdir(data_folder) if x.endswith('.txt')]
     logger.info(f'Found {len(data_files)} data files!')
+    # parsing is cpu bound, so the chunks of all files are parsed by
+    # a pool of processes and put back together per file. Chunks are
+    # submitted while reading, at most two per worker are pending, so
+    # the logs are never held in memory completely
+    max_workers = os.cpu_count() or 1
+    parsed_chunks = defaultdict(list)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers) as executor:
+        for whatsapp_log in data_files:
+            logger.info('Parsing file: {}'.format(whatsapp_log))
+            with open(os.path.join(data_folder, whatsapp_log)) as f:
+                for chunk in read_file_chunks(f, PARSE_CHUNK_SIZE):
+                    if len(pending) >= 2 * max_workers:
+                        collect_parsed_chunk(pending, parsed_chunks)
+                    future = executor.submit(parse_log_chunk, chunk)
+                    pending.append((whatsapp_log, future))
+        while pending:
+            collect_parsed_chunk(pending, parsed_chunks)
+
     for whatsapp_log in data_files:
-        logger.info('Parsing file: {}'.format(whatsapp_log))
-        with open(os.path.join(data_folder, whatsapp_log)) as f:
-            data = parse_file_to_leet(f.read())
-            df = pd.DataFrame(data)
-            if df.empty:
-                logger.warning('FAILED LOG: {}'.format(whatsapp_log))
-                continue
-            parsed_files[whatsapp_log] = pd.DataFrame(data)
+        df = pd.concat(parsed_chunks[whatsapp_log], ignore_index=True)
+        if df.empty:
+            logger.warning('FAILED LOG: {}'.format(whatsapp_log))
+            continue
+        parsed_files[whatsapp_log] = add_time_parts(df).astype(LOG_DTYPES)
     return parsed_files
 
 
+def collect_parsed_chunk(pending, parsed_chunks):
+    """
+    Waits for the oldest pending chunk of parse_log_files and adds it
+    to the parsed chunks of its file, keeping the order of the chunks
+
+    :param pending: (deque) (filename, future) of the submitted chunks
+    :param parsed_chunks: (dict) {'filename': (list) pd.DataFrame, ...}
+    """
+    whatsapp_log, future = pending.popleft()
+    parsed_chunks[whatsapp_log].append(pd.DataFrame(future.result()))
+
+
 if __name__ == '__main__':
     base_path = os.path.dirname(__file__)
     data_folder = os.path.join(base_path, '../test/test_data')
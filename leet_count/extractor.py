@@ -1,8 +1,59 @@
 import os
 import re
+import sys
+from collections import namedtuple
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Records of the single line parsers, lighter than a dict per message
+MessageDetails = namedtuple('MessageDetails',
+                            ['message_time', 'message_owner', 'message_text'])
+LeetFeatures = namedtuple('LeetFeatures',
+                          ['is_leet', 'is_zeet', 'is_420', 'is_soli',
+                           'is_fail'])
+
+# Timestamps start a line, only preceded by invisible direction or byte
+# order marks and the bracket of ios logs
+DATE_PREFIX_CHARS = '\u200e\u200f\ufeff['
+
+# Matches a complete message line of ios ([date] owner: text) and
+# android (date - owner: text) logs, text is the part after the last ': '
+MESSAGE_PATTERN = re.compile(
+    r'^[\u200e\u200f\ufeff]*(?P<bracket>\[)?'
+    r'(?:(?P<dmy>\d{2}\.\d{2}\.\d{2}, \d{2}:\d{2}(?::\d{2})?)'
+    r'|(?P<mdy>\d{1,2}/\d{1,2}/\d{1,2}, \d{2}:\d{2})(?::\d{2})?)'
+    r'(?(bracket)\] | - )'
+    r'(?P<owner>[^:\n]+)(?::[^\n]*)?: (?P<text>[^\n]*)$',
+    re.MULTILINE)
+
+# Patterns used by the single line parsers, the owner of ios
+# ([date] owner: text) and android (date - owner: text) lines ends
+# at its first ':'
+DATETIME_PATTERN = re.compile(
+    r'[\u200e\u200f\ufeff]*\[?'
+    r'(?:(?P<dmy>\d{2}\.\d{2}\.\d{2}, \d{2}:\d{2}(?::\d{2})?)'
+    r'|(?P<mdy>\d{1,2}/\d{1,2}/\d{1,2}, \d{2}:\d{2}))')
+OWNER_PATTERN = re.compile(r'(?:\] | - )([^:\n]+)(?::[^\n]*)?: ')
+
+# Logs are parsed in chunks of about this many characters, which
+# bounds the memory of the strings extracted by MESSAGE_PATTERN
+PARSE_CHUNK_SIZE = 1 << 20
+
+# Formats of timestamps with a fixed width, the digits of a timestamp
+# are read at DIGIT_POSITIONS instead of matching the format
+FIXED_WIDTH_FORMATS = {'%d.%m.%y, %H:%M': 15, '%d.%m.%y, %H:%M:%S': 18}
+DIGIT_POSITIONS = {15: [0, 1, 3, 4, 6, 7, 10, 11, 13, 14],
+                   18: [0, 1, 3, 4, 6, 7, 10, 11, 13, 14, 16, 17]}
+
+# Minutes of the day (hour * 60 + minute) of the notable events,
+# fails are the minute after leet, zeet or 420
+LEET_MINUTE = 13 * 60 + 37
+ZEET_MINUTE = 23 * 60 + 37
+MINUTES_420 = [4 * 60 + 20, 16 * 60 + 20]
+FAIL_MINUTES = [4 * 60 + 21, 16 * 60 + 21, LEET_MINUTE + 1, ZEET_MINUTE + 1]
 
 
 def parse_datetime(some_str):
@@ -13,67 +64,55 @@ def parse_datetime(some_str):
     :param some_str: (str) whatsapplog line to parse
     :return: datetime or None (if no formatting succeeeded)
     """
-    formats = [
-        (r'\d{2}\.\d{2}\.\d{2}, \d{2}:\d{2}:\d{2}', '%d.%m.%y, %H:%M:%S'),
-        (r'\d{1,2}/\d{1,2}/\d{1,2}, \d{2}:\d{2}', '%m/%d/%y, %H:%M'),
-        (r'\d{2}\.\d{2}\.\d{2}, \d{2}:\d{2}', '%d.%m.%y, %H:%M')]
-    date = None
-    for regex, date_format in formats:
-        date_match = re.search(regex, some_str)
-        if date_match:
-            date = datetime.strptime(date_match.group(), date_format)
-
-    return date
-
+    if not has_date_prefix(some_str):
+        return None
 
-def parse_owner_android(some_str):
-    """
-    Method that tries to parse the message owner of a log line,
-    needs to be also specific to system logs have been generated.
+    date_match = DATETIME_PATTERN.match(some_str)
+    if date_match is None:
+        return None
 
-    :param some_str: (str) Whatsapp log line
-    :return: (str) owner of message or None
-    """
-    regex = r' - .+: '
-    name_match = re.search(regex, some_str)
-    if name_match:
-        name = name_match.group()
-        # first 2 characters are ] and space, filter those by postition
-        name_filter = name[3:-2].split(':')[0]
+    if date_match.group('dmy'):
+        date_str = date_match.group('dmy')
+        if len(date_str) > 15:
+            date_format = '%d.%m.%y, %H:%M:%S'
+        else:
+            date_format = '%d.%m.%y, %H:%M'
     else:
-        name_filter = None
-    return name_filter
+        date_str = date_match.group('mdy')
+        date_format = '%m/%d/%y, %H:%M'
+    try:
+        return datetime.strptime(date_str, date_format)
+    except ValueError:
+        # matches the pattern, but is no valid date (e.g. 31.02.19)
+        return None
 
 
-def parse_owner(some_str):
+def has_date_prefix(some_str):
     """
-    Grouping function to parse either android or ios whatsapp logs
-    :param some_str:  (str) Whatsapp log line
-    :return: (str) owner of message or None
+    Cheap check if a line can start with a timestamp, lines without one
+    (e.g. continuation lines of multi line messages) skip the regex
+
+    :param some_str: (str) whatsapplog line to check
+    :return: (bool)
     """
-    name_filter = parse_owner_ios(some_str)
-    if name_filter is None:
-        name_filter = parse_owner_android(some_str)
-    return name_filter
+    return some_str.lstrip(DATE_PREFIX_CHARS)[:1].isdigit()
 
 
-def parse_owner_ios(some_str):
+def parse_owner(some_str):
     """
-    Method that tries to parse the message owner of a log line,
-    needs to be also specific to system logs have been generated.
+    Method that tries to parse the message owner of either an android
+    or ios whatsapp log line, both layouts are matched by one regex so
+    the line is only scanned once.
 
     :param some_str:  (str) Whatsapp log line
     :return: (str) owner of message or None
     """
-    regex = r'] .+: '
-    name_match = re.search(regex, some_str)
+    name_match = OWNER_PATTERN.search(some_str)
     if name_match:
-        name = name_match.group()
-        # first 2 characters are ] and space, filter those by postition
-        name_filter = name[2:-2].split(':')[0]
-    else:
-        name_filter = None
-    return name_filter
+        # a chat has only a few owners, interned all their messages
+        # share one string per name
+        return sys.intern(name_match.group(1))
+    return None
 
 
 def parse_text(some_str):
@@ -84,7 +123,7 @@ def parse_text(some_str):
     :param some_str: (str) Whatsapp log line
     :return:
     """
-    return some_str.split(': ')[-1].replace('\n', '')
+    return some_str.rsplit(': ', 1)[-1].rstrip('\n')
 
 
 def parse_details(log_line):
@@ -92,134 +131,283 @@ def parse_details(log_line):
     Function that parses date, message owner and message content from
     a whatsapp logline
     :param log_line:  (str) Whatsapp log line
-    :return: (dict) parsed message details or None
+    :return: (MessageDetails) parsed message details or None
+    if the line has no timestamp or message owner
     """
+    message_time = parse_datetime(log_line)
+    if message_time is None:
+        return None
+    message_owner = parse_owner(log_line)
+    if message_owner is None:
+        return None
 
-    try:
-        message_time = parse_datetime(log_line)
-        message_owner = parse_owner(log_line)
-        message_text = parse_text(log_line)
+    return MessageDetails(message_time=message_time,
+                          message_owner=message_owner,
+                          message_text=parse_text(log_line))
 
-        return dict(message_time=message_time, message_owner=message_owner,
-                    message_text=message_text)
-    except AttributeError:
-        return None
 
+def match_date_formats(parts):
+    """
+    Function that returns the timestamps extracted with MESSAGE_PATTERN
+    and their datetime formats, determined by the group that matched.
 
-def determine_leet(detail_dict):
-    ts = detail_dict['message_time']
-    if ts.minute == 37 and ts.hour == 13:
-        return 1
-    else:
-        return 0
+    :param parts: (pd.DataFrame) groups of MESSAGE_PATTERN, one row
+    per message, '' for groups that didn't match
+    :return: (tuple) (pd.Series) timestamps, (np.ndarray) datetime formats
+    """
+    is_dmy = (parts.dmy != '').values
+    date_strs = parts.dmy.where(is_dmy, parts.mdy)
+    date_formats = np.where(
+        is_dmy,
+        np.where(date_strs.str.len().values > 15,
+                 '%d.%m.%y, %H:%M:%S', '%d.%m.%y, %H:%M'),
+        '%m/%d/%y, %H:%M')
+    return date_strs, date_formats
 
 
-def determine_zeet(detail_dict):
-    ts = detail_dict['message_time']
-    if ts.minute == 37 and ts.hour == 23:
-        return 1
-    else:
-        return 0
+def parse_message_times(date_strs, date_formats):
+    """
+    Parses all timestamps of a log at once. Many messages share the same
+    minute, so every distinct timestamp is parsed only once and mapped
+    back to its messages. The distinct timestamps are grouped by format,
+    so every format is parsed by a single pd.to_datetime call.
+
+    :param date_strs: (list) timestamps
+    :param date_formats: (list) datetime format of every timestamp
+    :return: (pd.Series) datetimes in the order of date_strs,
+    NaT if a timestamp is not a valid date
+    """
+    codes, uniques = pd.factorize(np.asarray(date_strs, dtype=object))
+    unique_formats = np.empty(len(uniques), dtype=object)
+    unique_formats[codes] = date_formats
+
+    unique_times = np.full(len(uniques), np.datetime64('NaT'),
+                           dtype='datetime64[ns]')
+    for date_format in pd.unique(unique_formats):
+        idx = np.flatnonzero(unique_formats == date_format)
+        if date_format in FIXED_WIDTH_FORMATS:
+            unique_times[idx] = parse_fixed_width_times(
+                uniques[idx], FIXED_WIDTH_FORMATS[date_format])
+        else:
+            unique_times[idx] = pd.to_datetime(
+                uniques[idx], format=date_format, errors='coerce',
+                cache=False)
+    return pd.Series(unique_times[codes])
 
 
-def determine_420(detail_dict):
-    ts = detail_dict['message_time']
-    if ts.minute == 20 and (ts.hour == 16 or ts.hour == 4):
-        return 1
-    else:
-        return 0
+def parse_fixed_width_times(date_strs, width):
+    """
+    Parses 'dd.mm.yy, HH:MM' or 'dd.mm.yy, HH:MM:SS' timestamps by
+    reading the digits at their fixed positions, which is a lot faster
+    than pd.to_datetime matching the format for every timestamp.
+
+    :param date_strs: (np.ndarray) timestamps of the same format
+    :param width: (int) length of the timestamps, 15 or 18
+    :return: (np.ndarray) datetime64[ns], NaT if a timestamp is not
+    a valid date
+    """
+    chars = np.asarray(date_strs, dtype='U{}'.format(width))
+    digits = (chars.view(np.uint32).reshape(len(chars), width)
+              .astype(np.int64) - ord('0'))
+
+    def number(pos):
+        return digits[:, pos] * 10 + digits[:, pos + 1]
+
+    day, month, year = number(0), number(3), number(6)
+    # same century as %y, 69-99 are 1969-1999 and 00-68 are 2000-2068
+    year += np.where(year < 69, 2000, 1900)
+    hour, minute = number(10), number(13)
+    second = number(16) if width > 15 else 0
+
+    first_of_month = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    dates = first_of_month.astype('datetime64[D]') + (day - 1)
+    is_digit = (digits >= 0) & (digits <= 9)
+    # days beyond the end of a month roll over into the next one, like
+    # pd.to_datetime the leap seconds 60 and 61 are valid and roll over
+    valid = (is_digit[:, DIGIT_POSITIONS[width]].all(axis=1)
+             & (month >= 1) & (month <= 12) & (day >= 1)
+             & (dates.astype('datetime64[M]') == first_of_month)
+             & (hour < 24) & (minute < 60) & (second < 62))
+    times = (dates.astype('datetime64[ns]')
+             + ((hour * 60 + minute) * 60 + second) * np.timedelta64(1, 's'))
+    return np.where(valid, times, np.datetime64('NaT'))
+
+
+def build_leet_features(details):
+    """
+    function creating message features (either leet,zeet,420 soli or fail)
+    currently soli and fail are not processed by the aggregation script
 
+    :param details: (MessageDetails) message details (time,owner,text),
+    see parse_details
+    :return: (LeetFeatures) features of notable events, 1 or 0
+    """
+    ts = details.message_time
+    # the time checks only compare the minute of the day
+    minute_of_day = ts.hour * 60 + ts.minute
+    return LeetFeatures(
+        is_leet=int(minute_of_day == LEET_MINUTE),
+        is_zeet=int(minute_of_day == ZEET_MINUTE),
+        is_420=int(minute_of_day in MINUTES_420),
+        is_soli=int('soli' in details.message_text.lower()),
+        is_fail=int(minute_of_day in FAIL_MINUTES))
+
+
+def parse_file_to_leet(log_file):
+    """
+    Method that parses a whatsapp log, given as its content (str) or as
+    an open file. The log is parsed in chunks of PARSE_CHUNK_SIZE
+    characters, so only the messages of one chunk are held as strings
+    at a time, see parse_log_chunk
 
-def determine_soli(detail_dict):
-    message = detail_dict['message_text']
-    if 'soli' in message.lower():
-        return 1
+    :param log_file:  (str or file object) compelete Whatsapp log
+    :return: (dict): columns of all messages
+    {
+        'message_text':(str),
+        'message_time':(datetime64),
+        'message_owner': (pd.Categorical) str,
+        'is_leet':(int8) 1 or 0,
+        'is_zeet':(int8) 1 or 0,
+        'is_420':(int8) 1 or 0,
+        'is_soli': (int8) 1 or 0,
+        'is_fail': (int8) 1 or 0
+    }
+    add_time_parts adds year, month, day, hour and minute when needed
+    """
+    if isinstance(log_file, str):
+        chunks = split_file_content(log_file, PARSE_CHUNK_SIZE)
     else:
-        return 0
+        chunks = read_file_chunks(log_file, PARSE_CHUNK_SIZE)
+    parsed_chunks = [parse_log_chunk(chunk) for chunk in chunks]
+    if len(parsed_chunks) == 1:
+        return parsed_chunks[0]
+
+    columns = dict()
+    for key in parsed_chunks[0]:
+        values = [parsed_chunk[key] for parsed_chunk in parsed_chunks]
+        if key == 'message_owner':
+            columns[key] = union_categoricals(values)
+        else:
+            columns[key] = np.concatenate(values)
+    return columns
 
 
-def determine_fail(detail_dict):
-    ts = detail_dict['message_time']
-    if ts.minute == 38 and (ts.hour == 23 or ts.hour == 13):
-        return 1
-    elif ts.minute == 21 and (ts.hour == 16 or ts.hour == 4):
-        return 1
-    else:
-        return 0
+def parse_log_chunk(chunk):
+    """
+    Parses all complete lines of a log at once. First gets the message
+    details and if that succeedes calculates relevant events for all
+    messages, see parse_file_to_leet for the returned columns
 
+    :param chunk: (str) Whatsapp log lines
+    :return: (dict) columns of all messages
+    """
+    parts = pd.DataFrame(MESSAGE_PATTERN.findall(chunk),
+                         columns=sorted(MESSAGE_PATTERN.groupindex,
+                                        key=MESSAGE_PATTERN.groupindex.get))
+    parts = parts[parts.text != '']
+    date_strs, date_formats = match_date_formats(parts)
+
+    message_time = parse_message_times(date_strs.values, date_formats)
+    valid = message_time.notnull().values
+    texts = np.asarray(parts.text, dtype=object)[valid]
+    # owners are a handful of names, as categorical they are a lot
+    # smaller and faster to send back from worker processes
+    columns = dict(
+        message_time=message_time.values[valid],
+        message_owner=pd.Categorical(
+            np.asarray(parts.owner, dtype=object)[valid]),
+        message_text=texts,
+        is_soli=np.array(['soli' in x.lower() for x in texts],
+                         dtype=np.int8))
+    add_leet_features(columns)
+    return columns
+
+
+def split_file_content(file_content, chunk_size):
+    """
+    Splits the content of a log into chunks of at least chunk_size
+    characters that end at a line break, so every chunk can be parsed
+    on its own with parse_file_to_leet
 
-def build_leet_features(detail_dict):
+    :param file_content: (str) complete Whatsapp log
+    :param chunk_size: (int) minimal number of characters per chunk
+    :return: (list) chunks in the order of the log, at least one
     """
-    function creating message features (either leet,zeet,420 soli or fail)
-    currently soli and fail are not processed by the aggregation script
+    chunks = list()
+    start = 0
+    while start < len(file_content):
+        end = file_content.find('\n', start + chunk_size)
+        end = len(file_content) if end == -1 else end + 1
+        chunks.append(file_content[start:end])
+        start = end
+    return chunks or [file_content]
 
-    :param detail_dict: (dict) message details (time,owner,text)
-    {
-        'message_time':(datetime),
-        'message_text': (str),
-        'message_owner' (str)
-    }
 
-    :return: (dict) feature dict of notable events
-    """
-    is_leet = determine_leet(detail_dict)
-    is_zeet = determine_zeet(detail_dict)
-    is_420 = determine_420(detail_dict)
-    is_soli = determine_soli(detail_dict)
-    is_fail = determine_fail(detail_dict)
-    features = dict(is_leet=is_leet, is_zeet=is_zeet, is_420=is_420,
-                    is_soli=is_soli, is_fail=is_fail)
-    return features
-
-
-def parse_file_to_leet(file_content):
-    """
-    Method that parses file content (str) of a whatsapp log.
-    First gets message details and if that succeedes calculates
-    relevant events
-
-    :param file_content:  (str) compelete Whatsapp log line
-    :return: (list): list containing a dictionary for every log line
-    [
-        {
-         'message_text':(str),
-         'message_time':(datetime),
-         'message_owner': (str),
-         'is_leet':(int) 1 or 0,
-         'is_zeet':(int) 1 or 0,
-         'is_420':(int) 1 or 0,
-         'is_soli': (int) 1 or 0,
-         'is_fail': (int) 1 or 0,
-        },...
-    ]
-    """
-    data = list()
-    for line in file_content.split('\n'):
-        details = parse_details(line)
-        if details is None or not all(details.values()):
-            continue
-        else:
-            leet_features = build_leet_features(details)
-            details.update(leet_features)
-            details.update(split_time(details['message_time']))
-            data.append(details)
+def read_file_chunks(log_file, chunk_size):
+    """
+    Same as split_file_content for an open log file, reads the chunks
+    one at a time instead of the whole file
 
-    return data
+    :param log_file: (file object) Whatsapp log opened in text mode
+    :param chunk_size: (int) minimal number of characters per chunk
+    :return: (generator) chunks in the order of the log, at least one
+    """
+    chunk = log_file.read(chunk_size)
+    while True:
+        yield chunk + log_file.readline()
+        chunk = log_file.read(chunk_size)
+        if not chunk:
+            break
 
 
-def split_time(dt):
-    return dict(year=dt.year,
-                month=dt.month,
-                day=dt.day,
-                hour=dt.hour,
-                minute=dt.minute)
+def add_leet_features(columns):
+    """
+    Vectorized version of the time features of build_leet_features,
+    calculates the features for all messages at once and adds them
+    as int8 columns
+
+    :param columns: (dict or pd.DataFrame) messages with a message_time
+    column
+    :return: (dict or pd.DataFrame) columns with added
+    is_leet, is_zeet, is_420 and is_fail
+    """
+    minutes = np.asarray(columns['message_time'], dtype='datetime64[m]')
+    minute_of_day = (minutes - minutes.astype('datetime64[D]')).astype(
+        np.int32)
+    columns['is_leet'] = (minute_of_day == LEET_MINUTE).astype(np.int8)
+    columns['is_zeet'] = (minute_of_day == ZEET_MINUTE).astype(np.int8)
+    columns['is_420'] = np.isin(minute_of_day,
+                                MINUTES_420).astype(np.int8)
+    columns['is_fail'] = np.isin(minute_of_day,
+                                 FAIL_MINUTES).astype(np.int8)
+    return columns
+
+
+def add_time_parts(columns):
+    """
+    Adds year, month, day, hour and minute of the message_time column,
+    used by the aggregations in count_leets
+
+    :param columns: (dict or pd.DataFrame) messages with a message_time
+    column
+    :return: (dict or pd.DataFrame) columns with added
+    year (int16), month, day, hour and minute (int8)
+    """
+    times = pd.DatetimeIndex(columns['message_time'])
+    columns['year'] = np.asarray(times.year, dtype=np.int16)
+    columns['month'] = np.asarray(times.month, dtype=np.int8)
+    columns['day'] = np.asarray(times.day, dtype=np.int8)
+    columns['hour'] = np.asarray(times.hour, dtype=np.int8)
+    columns['minute'] = np.asarray(times.minute, dtype=np.int8)
+    return columns
 
 
 if __name__ == '__main__':
     base_path = os.path.dirname(__file__)
     test_path = os.path.join(base_path, '../test/test_data/joan_whatsapp.txt')
-    data = list()
-    with open(test_path) as f:
-        data = parse_file_to_leet(f.read())
-
-    pd.DataFrame(data).to_csv('foo.csv', index=False)
+    # every chunk is written as soon as it is parsed, so the csv is
+    # never held in memory completely
+    with open(test_path) as f, open('foo.csv', 'w', newline='') as out:
+        for i, chunk in enumerate(read_file_chunks(f, PARSE_CHUNK_SIZE)):
+            data = add_time_parts(parse_log_chunk(chunk))
+            pd.DataFrame(data).to_csv(out, header=i == 0, index=False)